@@ -1,21 +1,40 @@
 # backend/app.py
 import sys
 import os
+import asyncio
+import importlib.util
 import traceback
-import base64
+import hashlib
 import torch
 import numpy as np
 import httpx
 
 from io import BytesIO
-from typing import List, Dict, Optional, Tuple, Any
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple, Any, Literal
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from starlette.background import BackgroundTask
 
 from PIL import Image, ImageDraw, ImageFont
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+# pybase64 is a SIMD (SSSE3/AVX2) drop-in for the stdlib codec.
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# xxh3 hashes at memory bandwidth; blake2b is the stdlib fallback.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # Assuming SAM is in a subdirectory or installed
 try:
@@ -32,8 +51,8 @@ class FormatItem(BaseModel):
     width: int
     height: int
 
-class GenerateRequest(BaseModel):
-    sourceImage: str
+class GenerateParams(BaseModel):
+    """Everything in a generate request except the source image itself."""
     userInputHeroBbox: Optional[Dict[str,int]] = None
     
     # --- Logo ---
@@ -63,12 +82,38 @@ class GenerateRequest(BaseModel):
     ctaBgColor: Optional[str] = "#000000"
 
     formats: List[FormatItem]
+    # Encoding of the returned data URLs: PNG (lossless), WebP (smaller, lossy q90)
+    # or JPEG (q85, no alpha; fastest to encode for large formats)
+    outputFormat: Literal["png", "webp", "jpeg"] = "png"
+    # Use userInputHeroBbox as-is (no SAM pass) unless this asks SAM to tighten it
+    refineWithSam: bool = False
+
+class GenerateRequest(GenerateParams):
+    sourceImage: str
 
 class GenerateResponse(BaseModel):
     results: Dict[str,str]
 
 # --- Globals & Initialization ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for all Modal calls, so follow-up requests reuse the
+    # keep-alive connection instead of paying a TLS handshake each time.
+    try:
+        # Timeout: adjust based on expected inference time
+        timeout_seconds = float(os.getenv("MODAL_REQUEST_TIMEOUT", "300"))
+    except ValueError:
+        timeout_seconds = 300.0
+    app.state.http = httpx.AsyncClient(
+        timeout=timeout_seconds,
+        # HTTP/2 needs the optional `h2` package (httpx[http2])
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    yield
+    await app.state.http.aclose()
+
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost:3000",
     "https://www.lunarianworks.com",
@@ -117,19 +162,90 @@ def get_font_path(font_filename: Optional[str]) -> str:
         return DEFAULT_FONT_PATH
     return path
 
+@lru_cache(maxsize=512)
+def _load_font(path: str, size: int):
+    """ImageFont.truetype memoized on (path, size); falls back to PIL's default font."""
+    try:
+        return ImageFont.truetype(path, size)
+    except (IOError, TypeError):
+        return ImageFont.load_default()
+
+def _warm_font_cache(sizes: Tuple[int, ...] = (12, 24, 48)) -> None:
+    for path in set(FONT_MAP.values()):
+        if os.path.exists(path):
+            for size in sizes:
+                _load_font(path, size)
+
+_warm_font_cache()
+
 # --- End of new font handling ---
 
 sam_checkpoint_path = os.path.join(backend_dir, "sam_vit_b_01ec64.pth")
 sam_model_type = "vit_b"
-predictor = None
+# Survives module re-execution (e.g. importlib.reload) so the checkpoint is
+# only read once per process.
+predictor = globals().get("predictor")
+
+# Image embeddings from the SAM encoder, keyed by a hash of the RGB pixels.
+# Lets repeat requests for the same source image skip the ViT encoder.
+EMBED_CACHE: "OrderedDict[Tuple, dict]" = OrderedDict()
+EMBED_CACHE_MAX_SIZE = 32
+
+# The automatic mask generator runs a dense grid of point prompts, so it is
+# opt-in. By default the hero is found with a single full-image box prompt.
+USE_AUTO_MASK_GENERATOR = os.getenv("SAM_USE_AUTO_MASK_GENERATOR", "0") == "1"
+
+# SAM only has to locate the hero, so images are downscaled to this long side
+# before encoding (ViT cost grows with the token count). 0 disables it.
+HERO_BBOX_MAX_DIM = int(os.getenv("HERO_BBOX_MAX_DIM", "512"))
+
+# The predictor holds single-image state and concurrent encoder passes just
+# thrash the GPU, so SAM jobs queue on one slot instead.
+SAM_SLOT = asyncio.Semaphore(1)
+
+# Dedicated stream for the image H2D copy + encoder pass (CUDA only)
+SAM_STREAM = torch.cuda.Stream() if device == "cuda" else None
 
 # Removed global font variables like default_font_pil and current_font_path
 
+def load_sam_model(model_type: str, checkpoint_path: str):
+    """Build SAM and load its weights from a memory-mapped checkpoint.
+
+    The mapped tensors are assigned as the model's parameters (no copy), so on
+    CPU they stay backed by the page cache and workers forked after a preloaded
+    import (e.g. `gunicorn --preload`) share one copy of the checkpoint. Moving
+    the model to the GPU afterwards copies the weights as usual.
+    """
+    model = sam_model_registry[model_type](checkpoint=None)
+    try:
+        state_dict = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError) as e:
+        # torch < 2.1 has no mmap kwarg; legacy (non-zip) checkpoints can't be mapped.
+        print(f"mmap checkpoint load unavailable ({e}), falling back to a regular load.")
+        model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+        return model
+    # assign=True (torch >= 2.1, like mmap) keeps the mapped storage instead of
+    # copying every tensor into the freshly initialised parameters.
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
 try:
-    if SamPredictor and sam_model_registry and os.path.exists(sam_checkpoint_path):
+    if predictor is not None:
+        print("SAM model already loaded in this process, skipping reload.")
+    elif SamPredictor and sam_model_registry and os.path.exists(sam_checkpoint_path):
         print(f"Loading SAM model from: {sam_checkpoint_path}")
-        sam = sam_model_registry[sam_model_type](checkpoint=sam_checkpoint_path)
+        sam = load_sam_model(sam_model_type, sam_checkpoint_path)
         sam.to(device)
+        sam.eval()
+        if device == "cuda":
+            # Only the ViT encoder is halved; the prompt encoder and mask decoder
+            # are tiny and numerically sensitive, so they stay fp32.
+            sam.image_encoder = sam.image_encoder.half()
+            if os.getenv("SAM_TORCH_COMPILE", "0") == "1":
+                try:
+                    sam.image_encoder = torch.compile(sam.image_encoder, mode="reduce-overhead")
+                except Exception as e:
+                    print(f"torch.compile unavailable, using eager SAM encoder: {e}")
         predictor = SamPredictor(sam)
         print("✅ SAM model loaded.")
     else:
@@ -137,49 +253,163 @@ try:
 except Exception as e:
     print(f"Error during global initializations: {e}"); traceback.print_exc()
 
+# Built once next to the predictor: the constructor lays out point grids and wraps
+# the model in its own SamPredictor, which is wasted work per request.
+AUTO_MASK_GEN = globals().get("AUTO_MASK_GEN")
+if AUTO_MASK_GEN is None and predictor and USE_AUTO_MASK_GENERATOR and SamAutomaticMaskGenerator:
+    AUTO_MASK_GEN = SamAutomaticMaskGenerator(predictor.model)
+
 # --- Utility Functions ---
+@contextmanager
+def _sam_inference():
+    """No autograd bookkeeping for SAM calls, and fp16 autocast on CUDA."""
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=(device == "cuda")):
+        yield
+
 def decode_data_url(data_url: str) -> Image.Image:
     if not data_url: raise HTTPException(400, "Missing image data")
-    header, encoded = data_url.split(",",1) if "," in data_url else ("",data_url)
+    # Slice past the header instead of split(), which also builds the header string and a tuple.
+    encoded = data_url[data_url.find(",") + 1:]
     try: 
-        return Image.open(BytesIO(base64.b64decode(encoded))).convert("RGBA")
+        return Image.open(BytesIO(_b64.b64decode(encoded, validate=False))).convert("RGBA")
     except Exception as e: 
         print(f"Error decoding image: {e}")
         raise HTTPException(400, "Invalid image data")
 
-def encode_image_to_data_url(img: Image.Image) -> str:
+def encode_image_to_data_url(img: Image.Image, format: str = "PNG") -> str:
     buf = BytesIO()
-    img.save(buf, format="PNG")
-    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
-
-def get_hero_bbox_from_input_or_sam(img: Image.Image, user_bbox_xywh: Optional[Dict[str, int]]=None) -> Optional[Tuple[int,int,int,int]]:
+    if format == "WEBP":
+        # method=0 is libwebp's fastest mode; fine for previews where size doesn't matter
+        img.save(buf, format="WEBP", quality=85, method=0)
+    else:
+        # zlib level 1: several times faster than the default 6 for a modest size cost
+        img.save(buf, format="PNG", compress_level=1, optimize=False)
+    return f"data:image/{format.lower()};base64," + _b64.b64encode(buf.getvalue()).decode()
+
+def _img_key(img_np: np.ndarray) -> Tuple:
+    """Cache key for an image array. Hashes the pixel buffer in place (no tobytes() copy)."""
+    buf = np.ascontiguousarray(img_np)
+    if xxhash is not None:
+        digest = xxhash.xxh3_64_intdigest(buf)
+    else:
+        digest = hashlib.blake2b(buf, digest_size=16).hexdigest()
+    return (buf.shape, digest)
+
+def _set_image(predictor, img_np: np.ndarray) -> None:
+    """predictor.set_image, except that on CUDA the resized image is copied from
+    pinned memory on SAM_STREAM so the transfer can overlap other GPU work."""
+    if SAM_STREAM is None:
+        predictor.set_image(img_np)
+        return
+    input_image = predictor.transform.apply_image(img_np)
+    host_tensor = torch.as_tensor(input_image).pin_memory()
+    with torch.cuda.stream(SAM_STREAM):
+        input_tensor = host_tensor.to(predictor.device, non_blocking=True)
+        input_tensor = input_tensor.permute(2, 0, 1).contiguous()[None, :, :, :]
+        predictor.set_torch_image(input_tensor, img_np.shape[:2])
+    SAM_STREAM.synchronize()
+
+def _ensure_image_set(predictor, img_np: np.ndarray) -> None:
+    """Set `img_np` on the predictor, restoring a cached embedding when possible."""
+    key = _img_key(img_np)
+    cached = EMBED_CACHE.get(key)
+    if cached is not None:
+        EMBED_CACHE.move_to_end(key)
+        predictor.reset_image()
+        predictor.features = cached["features"]
+        predictor.original_size = cached["original_size"]
+        predictor.input_size = cached["input_size"]
+        predictor.is_image_set = True
+        return
+
+    _set_image(predictor, img_np)
+    EMBED_CACHE[key] = {
+        "features": predictor.features,
+        "original_size": predictor.original_size,
+        "input_size": predictor.input_size,
+    }
+    if len(EMBED_CACHE) > EMBED_CACHE_MAX_SIZE:
+        EMBED_CACHE.popitem(last=False)
+
+def _mask_bbox(m: np.ndarray) -> Optional[Tuple[int,int,int,int]]:
+    """Inclusive (x1, y1, x2, y2) extent of a boolean mask, or None if it is empty."""
+    # Per-axis any() is one pass over the mask; flatnonzero then only scans H + W flags.
+    y_idx = np.flatnonzero(np.any(m, axis=1))
+    if not y_idx.size:
+        return None
+    x_idx = np.flatnonzero(np.any(m, axis=0))
+    return int(x_idx[0]), int(y_idx[0]), int(x_idx[-1]), int(y_idx[-1])
+
+def _clamp_user_bbox(user_bbox_xywh: Dict[str, int], ow: int, oh: int) -> Optional[Tuple[int,int,int,int]]:
+    """User xywh box clipped to the image as (x1, y1, x2, y2), or None if nothing is left."""
+    x0,y0,w,h = user_bbox_xywh["x"],user_bbox_xywh["y"],user_bbox_xywh["width"],user_bbox_xywh["height"]
+    x1,y1 = max(0, x0), max(0, y0)
+    x2,y2 = min(ow, x0 + w), min(oh, y0 + h)
+    if x1 >= x2 or y1 >= y2:
+        return None
+    return (x1, y1, x2, y2)
+
+def get_hero_bbox_from_input_or_sam(img: Image.Image, user_bbox_xywh: Optional[Dict[str, int]]=None, refine_with_sam: bool = False) -> Optional[Tuple[int,int,int,int]]:
+    ow, oh = img.size
+    if user_bbox_xywh and not refine_with_sam:
+        user_box = _clamp_user_bbox(user_bbox_xywh, ow, oh)
+        if user_box:
+            print(f"Using user hero bbox as-is: {user_box}")
+            return user_box
+    if HERO_BBOX_MAX_DIM <= 0 or max(ow, oh) <= HERO_BBOX_MAX_DIM:
+        return _hero_bbox_at_scale(img, user_bbox_xywh)
+
+    # Run SAM on a downscaled copy and map the result back to source pixels
+    scale = HERO_BBOX_MAX_DIM / max(ow, oh)
+    small = img.resize((max(1, round(ow * scale)), max(1, round(oh * scale))), Image.BILINEAR)
+    sw, sh = small.size
+    fx, fy = ow / sw, oh / sh
+    small_user_bbox = None
+    if user_bbox_xywh:
+        small_user_bbox = {
+            "x": round(user_bbox_xywh["x"] / fx), "y": round(user_bbox_xywh["y"] / fy),
+            "width": round(user_bbox_xywh["width"] / fx), "height": round(user_bbox_xywh["height"] / fy),
+        }
+    bbox = _hero_bbox_at_scale(small, small_user_bbox)
+    if not bbox:
+        return None
+    x1, y1, x2, y2 = bbox
+    # Extents are inclusive pixel indices, so scale the pixel edges, not the indices
+    return (int(x1 * fx), int(y1 * fy), min(ow - 1, int((x2 + 1) * fx) - 1), min(oh - 1, int((y2 + 1) * fy) - 1))
+
+def _hero_bbox_at_scale(img: Image.Image, user_bbox_xywh: Optional[Dict[str, int]]=None) -> Optional[Tuple[int,int,int,int]]:
     ow, oh = img.size
-    img_np = np.array(img.convert("RGB"))
+    # Avoid the full-image convert("RGB") copy for the common RGB/RGBA inputs
+    if img.mode == "RGB":
+        img_np = np.asarray(img)
+    elif img.mode == "RGBA":
+        img_np = np.ascontiguousarray(np.asarray(img)[..., :3])
+    else:
+        img_np = np.asarray(img.convert("RGB"))
 
     if user_bbox_xywh and predictor:
-        x0,y0,w,h = user_bbox_xywh["x"],user_bbox_xywh["y"],user_bbox_xywh["width"],user_bbox_xywh["height"]
-        x1,y1 = max(0, x0), max(0, y0)
-        x2,y2 = min(ow, x0 + w), min(oh, y0 + h)
-        if x1 >= x2 or y1 >= y2:
+        user_box = _clamp_user_bbox(user_bbox_xywh, ow, oh)
+        if not user_box:
             print("User BBox invalid, trying SAM auto if available.")
         else:
+            x1,y1,x2,y2 = user_box
             try:
-                predictor.set_image(img_np)
-                masks, scores, _ = predictor.predict(box=np.array([[x1,y1,x2,y2]]), multimask_output=True)
+                with _sam_inference():
+                    _ensure_image_set(predictor, img_np)
+                    masks, scores, _ = predictor.predict(box=np.array([[x1,y1,x2,y2]]), multimask_output=True)
                 best_mask_idx = np.argmax(scores)
-                best_mask = masks[best_mask_idx]
-                ys, xs = np.nonzero(best_mask)
-                if xs.size and ys.size: 
-                    print(f"SAM derived bbox from user input: {(int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))}")
-                    return (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+                bbox = _mask_bbox(masks[best_mask_idx])
+                if bbox: 
+                    print(f"SAM derived bbox from user input: {bbox}")
+                    return bbox
             except Exception as e:
                 print(f"Error during SAM prediction with user box: {e}")
 
-    if predictor and SamAutomaticMaskGenerator:
+    if AUTO_MASK_GEN is not None:
         try:
-            auto_mask_generator = SamAutomaticMaskGenerator(predictor.model)
             print("Running SAM Automatic Mask Generator...")
-            sam_results = auto_mask_generator.generate(img_np)
+            with _sam_inference():
+                sam_results = AUTO_MASK_GEN.generate(img_np)
             if sam_results:
                 best_mask_info = max(sam_results, key=lambda m: m['area'])
                 x,y,w,h = best_mask_info['bbox']
@@ -189,10 +419,46 @@ def get_hero_bbox_from_input_or_sam(img: Image.Image, user_bbox_xywh: Optional[D
                 print("SAM auto-generator found no masks.")
         except Exception as e:
             print(f"Error during SAM automatic mask generation: {e}")
+    elif predictor:
+        try:
+            with _sam_inference():
+                _ensure_image_set(predictor, img_np)
+                masks, scores, _ = predictor.predict(box=np.array([[0,0,ow,oh]]), multimask_output=True)
+            bbox = _mask_bbox(masks[np.argmax(scores)])
+            if bbox:
+                print(f"SAM auto-detected hero bbox: {bbox}")
+                return bbox
+            else:
+                print("SAM found no mask for the full-image box.")
+        except Exception as e:
+            print(f"Error during SAM full-image box prediction: {e}")
     
     print("No hero bbox determined by SAM or user input.")
     return None
 
+def _resize_for_scale(img: Image.Image, size: Tuple[int, int], scale: float, box: Optional[Tuple[float, float, float, float]] = None) -> Image.Image:
+    # LANCZOS is by far the most expensive filter. For heavy downscales, let
+    # Pillow pre-shrink with reduce() and finish with BILINEAR; keep LANCZOS for
+    # near-1x and upscaling where its sharpness is visible.
+    if scale < 0.5:
+        return img.resize(size, Image.BILINEAR, box=box, reducing_gap=2.0)
+    return img.resize(size, Image.LANCZOS, box=box)
+
+def _resize_crop(src: Image.Image, scaled_size: Tuple[int, int], crop: Tuple[int, int, int, int], scale: float, tw: int, th: int, bg_color) -> Image.Image:
+    """Equivalent of src.resize(scaled_size).crop(crop) pasted on a (tw, th) canvas,
+    but resamples only the source region behind `crop`, straight to its final size."""
+    iw, ih = src.size
+    sx, sy = scaled_size[0] / iw, scaled_size[1] / ih
+    cx1, cy1, cx2, cy2 = crop
+    box = (cx1 / sx, cy1 / sy, min(iw, cx2 / sx), min(ih, cy2 / sy))
+    region = _resize_for_scale(src, (cx2 - cx1, cy2 - cy1), scale, box=box)
+    if region.size == (tw, th) and region.mode == "RGBA":
+        # Covers the whole canvas, so it can be the canvas
+        return region
+    canvas = Image.new("RGBA", (tw, th), bg_color)
+    canvas.paste(region, (0, 0))
+    return canvas
+
 def create_base_canvas_with_hero(
     src: Image.Image,
     tw: int,
@@ -206,16 +472,14 @@ def create_base_canvas_with_hero(
     bg_color=(255, 255, 255, 0) 
 ) -> Image.Image:
     iw, ih = src.size
-    canvas = Image.new("RGBA", (tw, th), bg_color)
-    if iw == 0 or ih == 0: return canvas
+    if iw == 0 or ih == 0: return Image.new("RGBA", (tw, th), bg_color)
 
     if not hero_bbox or hero_area_w <=0 or hero_area_h <=0 :
         scale = max(tw / iw if iw > 0 else 1, th / ih if ih > 0 else 1)
         rw, rh = int(iw * scale), int(ih * scale)
-        img2 = src.resize((rw, rh), Image.LANCZOS)
         cx, cy = (rw - tw) // 2, (rh - th) // 2
-        canvas.paste(img2.crop((max(0, cx), max(0, cy), min(rw, cx + tw), min(rh, cy + th))), (0, 0))
-        return canvas
+        crop = (max(0, cx), max(0, cy), min(rw, cx + tw), min(rh, cy + th))
+        return _resize_crop(src, (rw, rh), crop, scale, tw, th, bg_color)
 
     x1, y1, x2, y2 = hero_bbox
     h_w, h_h = x2 - x1, y2 - y1
@@ -234,7 +498,6 @@ def create_base_canvas_with_hero(
     
     scaled_iw, scaled_ih = int(iw * final_scale), int(ih * final_scale)
     scaled_iw, scaled_ih = max(tw, scaled_iw), max(th, scaled_ih) 
-    img_resized = src.resize((scaled_iw, scaled_ih), Image.LANCZOS)
 
     scaled_hero_cx, scaled_hero_cy = hcx * final_scale, hcy * final_scale
     
@@ -247,102 +510,92 @@ def create_base_canvas_with_hero(
     crop_x = max(0, min(crop_x, scaled_iw - tw))
     crop_y = max(0, min(crop_y, scaled_ih - th))
 
-    final_img_to_paste = img_resized.crop((int(crop_x), int(crop_y), int(crop_x + tw), int(crop_y + th)))
-    canvas.paste(final_img_to_paste, (0, 0))
-    return canvas
+    crop = (int(crop_x), int(crop_y), int(crop_x + tw), int(crop_y + th))
+    return _resize_crop(src, (scaled_iw, scaled_ih), crop, final_scale, tw, th, bg_color)
+
+# Anchor of each element position within its zone, in half-zone units:
+# 0 = left/top edge, 1 = centered, 2 = right/bottom edge.
+_POS_KEY_ANCHORS: Dict[str, Tuple[int, int]] = {
+    "top_left": (0, 0),
+    "top_center": (1, 0),
+    "top_right": (2, 0),
+    "middle_left": (0, 1),
+    "middle_center": (1, 1),
+    "middle_right": (2, 1),
+    "bottom_left": (0, 2),
+    "bottom_center": (1, 2),
+    "bottom_right": (2, 2),
+    "left_middle": (0, 1),
+    "right_middle": (2, 1),
+    "center": (1, 0),
+}
 
 def get_element_position(pos_key: str, el_w: int, el_h: int, zone_x: int, zone_y: int, zone_w: int, zone_h: int) -> Tuple[int, int]:
-    px, py = zone_x, zone_y 
+    ax, ay = _POS_KEY_ANCHORS.get(pos_key, (0, 0))
+    return int(zone_x + (zone_w - el_w) * ax // 2), int(zone_y + (zone_h - el_h) * ay // 2)
 
-    if "left" in pos_key: px = zone_x
-    elif "right" in pos_key: px = zone_x + zone_w - el_w
-    elif "center" in pos_key: px = zone_x + (zone_w - el_w) // 2
-    
-    if "top" in pos_key: py = zone_y
-    elif "bottom" in pos_key: py = zone_y + zone_h - el_h
-    elif "middle" in pos_key: py = zone_y + (zone_h - el_h) // 2
-    
-    return int(px), int(py)
+def _sample_text_height(font_path: str, size: int, sample_text: str) -> int:
+    # Safely load the font, falling back to PIL's default if the path is bad
+    fnt = _load_font(font_path, size)
+    try:
+        bbox = fnt.getbbox(sample_text)
+        return bbox[3] - bbox[1] if bbox else size
+    except Exception:
+        return size
 
 def find_font_size_for_height(target_height: int, current_font_path: str, min_size: int = 10, max_size: int = 128, sample_text: str = "Aj") -> int:
-    # This function now relies entirely on the passed `current_font_path`
-    best_size = min_size
-    best_diff = float('inf')
-    
+    # Glyph height scales (nearly) linearly with the requested size, so one
+    # measurement at a reference size gives an estimate, and one measurement
+    # at the estimate gives a correction with the same ratio.
+    reference_size = 64
     target_height = max(1, target_height)
-    
-    low, high = min_size, max_size
-    while low <= high:
-        mid = (low + high) // 2
-        if mid <= 0:
-            low = 1
-            continue
-        try:
-            # Safely load the font, falling back to PIL's default if the path is bad
-            fnt = ImageFont.truetype(current_font_path, mid)
-        except (IOError, TypeError):
-            fnt = ImageFont.load_default()
-        
-        try:
-            bbox = fnt.getbbox(sample_text)
-            h = bbox[3] - bbox[1] if bbox else mid 
-        except Exception:
-            h = mid 
-        
-        diff = abs(h - target_height)
-        if diff < best_diff:
-            best_diff = diff
-            best_size = mid
-        
-        if h < target_height:
-            low = mid + 1
-        elif h > target_height:
-            high = mid - 1
-        else:
-            return mid
-            
-    return best_size
-
-def get_edges_for_pos_key(pos_key: str) -> set:
-    edges = set()
-    if "top" in pos_key: edges.add("top")
-    if "bottom" in pos_key: edges.add("bottom")
-    if "left" in pos_key: edges.add("left")
-    if "right" in pos_key: edges.add("right")
-    if pos_key in ("top_center", "bottom_center"): edges.add("top" if "top" in pos_key else "bottom")
-    if pos_key in ("left_middle", "right_middle"): edges.add("left" if "left" in pos_key else "right")
-    return edges
+    min_size = max(1, min_size)
+
+    h0 = max(1, _sample_text_height(current_font_path, reference_size, sample_text))
+    est = int(round(reference_size * target_height / h0))
+    est = max(min_size, min(max_size, est))
+
+    h = _sample_text_height(current_font_path, est, sample_text)
+    if h > 0 and h != target_height:
+        est = int(round(est * target_height / h))
+        est = max(min_size, min(max_size, est))
+    return est
+
+# Page edges occupied by each element position. Covers the frontend's
+# top/middle/bottom x left/center/right grid plus the legacy *_middle keys.
+_POS_KEY_EDGES: Dict[str, frozenset] = {
+    "top_left": frozenset({"top", "left"}),
+    "top_center": frozenset({"top"}),
+    "top_right": frozenset({"top", "right"}),
+    "middle_left": frozenset({"left"}),
+    "middle_center": frozenset(),
+    "middle_right": frozenset({"right"}),
+    "bottom_left": frozenset({"bottom", "left"}),
+    "bottom_center": frozenset({"bottom"}),
+    "bottom_right": frozenset({"bottom", "right"}),
+    "left_middle": frozenset({"left"}),
+    "right_middle": frozenset({"right"}),
+}
+
+def get_edges_for_pos_key(pos_key: str) -> frozenset:
+    return _POS_KEY_EDGES.get(pos_key, frozenset())
 
 # --- Main Ad Generation Logic ---
-@app.post("/generate")
-async def proxy_generate(req: GenerateRequest):
-    """
-    Proxy /generate requests to the Modal endpoint.
-    Expects environment variable MODAL_URL set to base URL (without trailing slash),
-    e.g. 'https://cyzmcl--lunarian-backend-modal-fastapi-app.modal.run'.
-    """
+def _modal_url(path: str) -> str:
     modal_base = os.getenv("MODAL_URL")
     if not modal_base:
         raise HTTPException(status_code=500, detail="MODAL_URL environment variable not set")
-
-    # Construct full URL for Modal generate endpoint
     # Ensure no double slash: if MODAL_URL ends with '/', strip it
-    modal_url = modal_base.rstrip("/") + "/generate"
-
-    try:
-        # Timeout: adjust based on expected inference time
-        timeout_seconds = float(os.getenv("MODAL_REQUEST_TIMEOUT", "300"))
-    except ValueError:
-        timeout_seconds = 300.0
+    return modal_base.rstrip("/") + path
 
+async def _stream_from_modal(client: httpx.AsyncClient, upstream_req: httpx.Request) -> StreamingResponse:
+    """Send `upstream_req` to Modal and stream its response back to the caller."""
     try:
-        async with httpx.AsyncClient(timeout=timeout_seconds) as client:
-            # Forward JSON body exactly
-            resp = await client.post(modal_url, json=req.dict())
-            # If Modal returned non-2xx, raise for status to catch below
+        resp = await client.send(upstream_req, stream=True)
+        if resp.is_error:
+            # Buffer the error body so it can be reported below
+            await resp.aread()
             resp.raise_for_status()
-            # Return the JSON as-is
-            return resp.json()
     except httpx.HTTPStatusError as e:
         # Modal responded with an HTTP error code
         status = e.response.status_code
@@ -359,39 +612,99 @@ async def proxy_generate(req: GenerateRequest):
         # Unexpected errors
         raise HTTPException(status_code=500, detail=f"Unexpected error proxying to Modal: {e}")
 
+    # aiter_bytes (not aiter_raw) so any content-encoding from Modal is undone
+    # before the body is re-sent without that header.
+    return StreamingResponse(
+        resp.aiter_bytes(),
+        status_code=resp.status_code,
+        media_type="application/json",
+        background=BackgroundTask(resp.aclose),
+    )
 
-# --- Debug Endpoint ---
-@app.post("/debug_hero_mask")
-async def debug_hero_mask_endpoint(req: GenerateRequest):
+@app.post("/generate")
+async def proxy_generate(request: Request):
+    """
+    Proxy /generate requests to the Modal endpoint.
+    Expects environment variable MODAL_URL set to base URL (without trailing slash),
+    e.g. 'https://cyzmcl--lunarian-backend-modal-fastapi-app.modal.run'.
+
+    The inbound JSON body is forwarded byte-for-byte and Modal's response is
+    streamed back, so the (multi-MB) base64 payloads are never re-serialized here.
+    """
+    raw = await request.body()
+    # Still validate up front so malformed requests get a 422 without a Modal round-trip
+    try:
+        GenerateRequest.model_validate_json(raw)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    client: httpx.AsyncClient = request.app.state.http
+    upstream_req = client.build_request(
+        "POST", _modal_url("/generate"), content=raw, headers={"content-type": "application/json"}
+    )
+    return await _stream_from_modal(client, upstream_req)
+
+@app.post("/generate_multipart")
+async def proxy_generate_multipart(request: Request, image: UploadFile = File(...), params: str = Form(...)):
+    """
+    Like /generate, but the source image is a raw file upload and the rest of the
+    request is a JSON `params` form field (a GenerateParams). The image bytes are
+    streamed to Modal's /generate_multipart untouched, skipping the base64 round-trip.
+    """
     try:
-        src_img_pil = decode_data_url(req.sourceImage)
-        ow, oh = src_img_pil.size
-        print(f"Debug: Img size: {src_img_pil.size}, mode: {src_img_pil.mode}")
+        GenerateParams.model_validate_json(params)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    client: httpx.AsyncClient = request.app.state.http
+    upstream_req = client.build_request(
+        "POST", _modal_url("/generate_multipart"),
+        data={"params": params},
+        files={"image": (image.filename or "image", image.file, image.content_type or "application/octet-stream")},
+    )
+    return await _stream_from_modal(client, upstream_req)
+
+
+# --- Debug Endpoint ---
+def _debug_hero_mask_work(req: GenerateRequest) -> Dict[str, Any]:
+    src_img_pil = decode_data_url(req.sourceImage)
+    ow, oh = src_img_pil.size
+    print(f"Debug: Img size: {src_img_pil.size}, mode: {src_img_pil.mode}")
+    
+    # Neither SAM nor the response reuses the decoded image, so both can use it
+    # as-is: SAM only reads it, and decode_data_url already returned RGBA to draw on.
+    hero_bbox = get_hero_bbox_from_input_or_sam(src_img_pil, req.userInputHeroBbox, req.refineWithSam)
+    
+    viz = src_img_pil
+    draw_viz = ImageDraw.Draw(viz)
+    
+    debug_font_size = max(15, int(min(ow,oh)*0.03)) 
+    # Use the default font path for debugging text
+    dfont = _load_font(DEFAULT_FONT_PATH, debug_font_size)
+    
+    if hero_bbox:
+        x1,y1,x2,y2 = hero_bbox
+        draw_viz.rectangle([x1,y1,x2,y2],outline="lime",width=max(1,int(min(ow,oh)*0.005))) 
         
-        hero_bbox = get_hero_bbox_from_input_or_sam(src_img_pil.copy(), req.userInputHeroBbox)
+        hero_mask_overlay = Image.new("RGBA", src_img_pil.size, (0,0,0,0)) 
+        draw_hero_mask = ImageDraw.Draw(hero_mask_overlay)
+        draw_hero_mask.rectangle([x1,y1,x2,y2], fill=(0,255,0,70)) 
+        viz = Image.alpha_composite(viz, hero_mask_overlay)
         
-        viz = src_img_pil.copy().convert("RGBA")
         draw_viz = ImageDraw.Draw(viz)
+        draw_viz.text((10,10),f"Hero BBox: ({x1},{y1})-({x2},{y2})",fill="lime",font=dfont)
+    else: 
+        draw_viz.text((10,10),"No hero bbox detected.",fill="red",font=dfont)
         
-        debug_font_size = max(15, int(min(ow,oh)*0.03)) 
-        # Use the default font path for debugging text
-        dfont = ImageFont.truetype(DEFAULT_FONT_PATH, debug_font_size)
-        
-        if hero_bbox:
-            x1,y1,x2,y2 = hero_bbox
-            draw_viz.rectangle([x1,y1,x2,y2],outline="lime",width=max(1,int(min(ow,oh)*0.005))) 
-            
-            hero_mask_overlay = Image.new("RGBA", src_img_pil.size, (0,0,0,0)) 
-            draw_hero_mask = ImageDraw.Draw(hero_mask_overlay)
-            draw_hero_mask.rectangle([x1,y1,x2,y2], fill=(0,255,0,70)) 
-            viz = Image.alpha_composite(viz, hero_mask_overlay)
-            
-            draw_viz = ImageDraw.Draw(viz)
-            draw_viz.text((10,10),f"Hero BBox: ({x1},{y1})-({x2},{y2})",fill="lime",font=dfont)
-        else: 
-            draw_viz.text((10,10),"No hero bbox detected.",fill="red",font=dfont)
-            
-        return {"debug_image":encode_image_to_data_url(viz),"hero_bbox":hero_bbox,"image_size":src_img_pil.size}
+    return {"debug_image":encode_image_to_data_url(viz, format="WEBP"),"hero_bbox":hero_bbox,"image_size":src_img_pil.size}
+
+@app.post("/debug_hero_mask")
+async def debug_hero_mask_endpoint(req: GenerateRequest):
+    try:
+        # Decoding, SAM and PNG encoding all block; run them in a worker thread
+        # so the event loop keeps serving other requests (and health checks).
+        async with SAM_SLOT:
+            return await asyncio.to_thread(_debug_hero_mask_work, req)
     except Exception as e: 
         print(f"Error in /debug_hero_mask: {e}"); traceback.print_exc()
-        raise HTTPException(status_code=500,detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500,detail=str(e))
@@ -1,5 +1,9 @@
 # test_debug_mask.py
-import base64
+# Faster SIMD codec if installed; same b64encode/b64decode API
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 import requests
 import json # For printing the response nicely
 
@@ -7,10 +11,14 @@ import json # For printing the response nicely
 # Make sure these files exist in the same directory as this script,
 # or provide the full path.
 SOURCE_IMAGE_PATH = "test.jpg"  # The image you want to test the hero mask detection on
-OUTPUT_IMAGE_PATH = "debug_mask_output.png" # Where the debug visualization will be saved
+OUTPUT_IMAGE_PATH = "debug_mask_output.webp" # Where the debug visualization will be saved
 DEBUG_ENDPOINT_URL = "http://localhost:8000/debug_hero_mask"
 # --- End Configuration ---
 
+# Pooled keep-alive connections, so repeated debug calls skip the TCP handshake
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 def image_to_data_url(filepath):
     """Converts an image file to a data URL."""
     try:
@@ -71,6 +79,7 @@ def main():
         # These are not strictly needed by the /debug_hero_mask endpoint as defined,
         # but including them won't hurt if GenerateRequest is the Pydantic model.
         "userInputHeroBbox":{ "x": 200, "y": 100, "width": 600, "height": 700},
+        "refineWithSam": True, # Otherwise the user box comes back untouched, without a SAM mask
         "brandLogo": None, 
         "brandColor": "#000000",
         "brandPosition": "top_left",
@@ -83,7 +92,7 @@ def main():
     # 3) POST to your running backend's debug endpoint
     print(f"Sending request to: {DEBUG_ENDPOINT_URL}")
     try:
-        resp = requests.post(DEBUG_ENDPOINT_URL, json=payload)
+        resp = session.post(DEBUG_ENDPOINT_URL, json=payload)
         resp.raise_for_status()  # Will error out if status != 200
 
         # 4) Process the response
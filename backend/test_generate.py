@@ -1,5 +1,9 @@
 # test_generate.py
-import base64
+# pybase64 is a drop-in for the stdlib module, just faster on big payloads
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 import requests
 
 # 1) Load & encode your source image
@@ -24,8 +28,11 @@ payload = {
     ]
 }
 
-# 4) POST to your running backend
-resp = requests.post("http://localhost:8000/generate", json=payload)
+# 4) POST to your running backend, over a keep-alive session so repeat calls
+#    (e.g. from a REPL) reuse the connection
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+resp = session.post("http://localhost:8000/generate", json=payload)
 resp.raise_for_status()  # will error out if status != 200
 
 # 5) Extract and save the returned image